@@ -1,118 +1,316 @@
+import asyncio
 import csv
-import requests
+import hashlib
+import json
 import logging
-from collections import defaultdict
+import sys
+import time
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
 from datetime import datetime
+from pathlib import Path
+
+import aiohttp
+import orjson
+
+try:
+    import numpy as np
+    from numba import njit
+except ImportError:  # numba is optional; Counter-based tally is used instead
+    np = None
 
 # --- Configuration ---
 ALL_PLAYERS = ["jcorr92", "xensprinkles", "euratoole", "teamoth"]
+PLAYERS_LOWER = frozenset(p.lower() for p in ALL_PLAYERS)
+PLAYER_NAMES = sorted(PLAYERS_LOWER)
+PLAYER_INDEX = {name: idx for idx, name in enumerate(PLAYER_NAMES)}
+OUTCOME_CODE = {"win": 0, "loss": 1, "draw": 2}
+# Chess.com's documented result codes, collapsed to win/loss/draw. Anything
+# unlisted (e.g. "abandoned") is ignored.
+OUTCOME_MAP = {
+    "win": "win",
+    "checkmated": "loss",
+    "timeout": "loss",
+    "resigned": "loss",
+    "lose": "loss",
+    "kingofthehill": "loss",
+    "threecheck": "loss",
+    "agreed": "draw",
+    "repetition": "draw",
+    "50move": "draw",
+    "insufficient": "draw",
+    "stalemate": "draw",
+    "timevsinsufficient": "draw",
+}
 HEADERS = {
     "User-Agent": "chess-leaderboard-script/1.0 (jcb.corr92@gmail.com)"
 }
 WIN_POINTS = 3
 DRAW_POINTS = 1
 ROLLING_GAME_COUNT = 30
+# No club games exist before this month, so older archives are never fetched.
+CLUB_START = "2024/01"
+MAX_CONCURRENT_REQUESTS = 8
+POOL_MAX_SIZE = 32
+RETRY_STATUSES = {429, 502, 503, 504}
+MAX_RETRIES = 3
+RETRY_BACKOFF = 0.5
+CACHE_DIR = Path.home() / ".cache" / "chess_leaderboard"
+ARCHIVE_INDEX_FILE = "archive_index.json"
 
 # --- Logging Setup ---
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
 logger = logging.getLogger(__name__)
 
+# --- Archive Cache ---
+def cache_path(url):
+    return CACHE_DIR / f"{hashlib.sha1(url.encode()).hexdigest()}.json"
+
+def is_current_month(url):
+    # Current month's archive is still growing, so never trust a cached copy.
+    return url.endswith(datetime.utcnow().strftime("%Y/%m"))
+
+def load_cached(url):
+    path = cache_path(url)
+    if not path.exists():
+        return None
+    try:
+        return orjson.loads(path.read_bytes())
+    except (OSError, ValueError):
+        logger.warning(f"Discarding unreadable cache entry for {url}")
+        return None
+
+def store_cached(url, etag, games):
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    cache_path(url).write_bytes(orjson.dumps({"etag": etag, "games": games}))
+
+# --- Game Storage ---
+@dataclass
+class GameColumns:
+    """Columnar (struct-of-arrays) storage for parsed games.
+
+    One entry per game across all parallel lists; avoids allocating a
+    per-game dict and keeps iteration over single fields tight. Player
+    and outcome are additionally stored as small integer codes
+    (PLAYER_INDEX / OUTCOME_CODE) so the tally loop can run on compact
+    numeric arrays.
+    """
+    end_times: list = field(default_factory=list)
+    players: list = field(default_factory=list)
+    opponents: list = field(default_factory=list)
+    outcomes: list = field(default_factory=list)
+    urls: list = field(default_factory=list)
+    player_codes: list = field(default_factory=list)
+    outcome_codes: list = field(default_factory=list)
+
+    _FIELDS = ("end_times", "players", "opponents", "outcomes", "urls",
+               "player_codes", "outcome_codes")
+
+    def __len__(self):
+        return len(self.end_times)
+
+    def append(self, end_time, player, opponent, outcome, url):
+        self.end_times.append(end_time)
+        self.players.append(player)
+        self.opponents.append(opponent)
+        self.outcomes.append(outcome)
+        self.urls.append(url)
+        self.player_codes.append(PLAYER_INDEX[player])
+        self.outcome_codes.append(OUTCOME_CODE[outcome])
+
+    def sort_by_end_time(self):
+        order = sorted(range(len(self)), key=self.end_times.__getitem__)
+        for name in self._FIELDS:
+            column = getattr(self, name)
+            setattr(self, name, [column[i] for i in order])
+
+# --- Archive Index ---
+def load_archive_index(filename=ARCHIVE_INDEX_FILE):
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_archive_index(columns, filename=ARCHIVE_INDEX_FILE):
+    earliest = {}
+    for player, end_time in zip(columns.players, columns.end_times):
+        month = datetime.utcfromtimestamp(end_time).strftime("%Y/%m")
+        if month < earliest.get(player, "9999/99"):
+            earliest[player] = month
+    with open(filename, "w") as f:
+        json.dump(earliest, f, indent=2)
+    logger.info(f"Saved archive index to {filename}")
+
 # --- API Helpers ---
-def fetch_archives(username):
+async def get_with_retries(session, url, headers=None):
+    """GET a URL, retrying transient failures with exponential backoff."""
+    for attempt in range(MAX_RETRIES):
+        response = await session.get(url, headers=headers)
+        if response.status not in RETRY_STATUSES:
+            return response
+        response.release()
+        delay = RETRY_BACKOFF * (2 ** attempt)
+        logger.warning(f"Got {response.status} from {url}, retrying in {delay:.1f}s")
+        await asyncio.sleep(delay)
+    return await session.get(url, headers=headers)
+
+async def fetch_archives(session, username):
     url = f"https://api.chess.com/pub/player/{username}/games/archives"
     logger.info(f"Fetching archives for {username}")
-    response = requests.get(url, headers=HEADERS)
-    if response.status_code == 403:
-        logger.warning(f"Access denied for {username} (403). Check privacy settings.")
-        return []
-    response.raise_for_status()
-    return response.json().get('archives', [])
-
-def fetch_games(archive_url):
-    logger.info(f"Fetching games from {archive_url}")
-    response = requests.get(archive_url, headers=HEADERS)
-    response.raise_for_status()
-    return response.json().get('games', [])
+    async with await get_with_retries(session, url) as response:
+        if response.status == 403:
+            logger.warning(f"Access denied for {username} (403). Check privacy settings.")
+            return []
+        response.raise_for_status()
+        return orjson.loads(await response.read()).get('archives', [])
+
+async def fetch_games(session, archive_url, semaphore):
+    cached = None if is_current_month(archive_url) else load_cached(archive_url)
+    headers = {"If-None-Match": cached["etag"]} if cached and cached.get("etag") else None
+
+    async with semaphore:
+        logger.info(f"Fetching games from {archive_url}")
+        async with await get_with_retries(session, archive_url, headers=headers) as response:
+            if response.status == 304 and cached is not None:
+                logger.info(f"Archive unchanged, using cache for {archive_url}")
+                return cached["games"]
+            response.raise_for_status()
+            games = orjson.loads(await response.read()).get('games', [])
+            if not is_current_month(archive_url):
+                store_cached(archive_url, response.headers.get("ETag", ""), games)
+            return games
+
+async def fetch_all_games(players, archive_index):
+    """Fetch every relevant monthly archive for every player concurrently.
+
+    Archives from before a player's earliest recorded club game (per the
+    archive index from the previous run) are skipped outright. Returns a
+    list of (player, games) pairs, one per monthly archive.
+    """
+    connector = aiohttp.TCPConnector(limit=POOL_MAX_SIZE, limit_per_host=MAX_CONCURRENT_REQUESTS)
+    async with aiohttp.ClientSession(headers=HEADERS, connector=connector) as session:
+        archive_lists = await asyncio.gather(*(fetch_archives(session, p) for p in players))
+
+        # Archive URLs end in /YYYY/MM, so a lexicographic compare on the
+        # suffix orders them chronologically.
+        targets = [(player, url)
+                   for player, archives in zip(players, archive_lists)
+                   for url in archives
+                   if url[-7:] >= max(CLUB_START, archive_index.get(player, ""))]
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+        results = await asyncio.gather(
+            *(fetch_games(session, url, semaphore) for _, url in targets),
+            return_exceptions=True
+        )
+
+    fetched = []
+    for (player, url), result in zip(targets, results):
+        if isinstance(result, BaseException):
+            logger.warning(f"Failed to fetch from {url}: {result}")
+            continue
+        fetched.append((player, result))
+    return fetched
 
 # --- Game Parsing ---
-def parse_daily_games(player, opponents, game_list):
-    archives = fetch_archives(player)
-
-    for url in archives:
-        try:
-            games = fetch_games(url)
-        except Exception as e:
-            logger.warning(f"Failed to fetch from {url}: {e}")
+def classify_archive(player, games):
+    """Classify one archive's games into row tuples for both perspectives.
+
+    Pure function of its arguments so it can run in a worker process;
+    deduplication against other archives happens at merge time in main.
+    """
+    opponents = PLAYERS_LOWER - {player}
+    rows = []
+    for game in games:
+        if game.get("time_class") != "daily":
+            continue
+
+        game_url = game.get("url", "")
+        white = game.get("white", {}).get("username", "").lower()
+        black = game.get("black", {}).get("username", "").lower()
+        result_white = game.get("white", {}).get("result", "")
+        result_black = game.get("black", {}).get("result", "")
+        end_time = game.get("end_time", 0)
+
+        if player not in (white, black):
+            continue
+
+        opponent = black if white == player else white
+        if opponent not in opponents:
             continue
 
-        for game in games:
-            if game.get("time_class") != "daily":
-                continue
-
-            white = game.get("white", {}).get("username", "").lower()
-            black = game.get("black", {}).get("username", "").lower()
-            result_white = game.get("white", {}).get("result", "")
-            result_black = game.get("black", {}).get("result", "")
-            end_time = game.get("end_time", 0)
-
-            if player not in (white, black):
-                continue
-
-            opponent = black if white == player else white
-            if opponent not in opponents:
-                continue
-
-            if player == white:
-                player_result = result_white
-            else:
-                player_result = result_black
-
-            if player_result == "win":
-                outcome = "win"
-            elif player_result in {"checkmated", "timeout", "resigned", "lose"}:
-                outcome = "loss"
-            elif "draw" in player_result or player_result == "stalemate":
-                outcome = "draw"
-            else:
-                continue
-
-            game_list.append({
-                "player": player,
-                "opponent": opponent,
-                "outcome": outcome,
-                "end_time": end_time,
-                "url": game.get("url", "")
-            })
+        if player == white:
+            player_result, opponent_result = result_white, result_black
+        else:
+            player_result, opponent_result = result_black, result_white
+
+        outcome = OUTCOME_MAP.get(player_result)
+        if outcome is not None:
+            rows.append((end_time, player, opponent, outcome, game_url))
+
+        opponent_outcome = OUTCOME_MAP.get(opponent_result)
+        if opponent_outcome is not None:
+            rows.append((end_time, opponent, player, opponent_outcome, game_url))
+
+    return rows
 
 # --- Leaderboard Aggregation ---
-def compute_leaderboard(game_list):
-    stats = defaultdict(lambda: {"games": 0, "wins": 0, "draws": 0, "losses": 0})
-    for game in game_list:
-        player = game["player"]
-        outcome = game["outcome"]
-        stats[player]["games"] += 1
-        if outcome == "win":
-            stats[player]["wins"] += 1
-        elif outcome == "draw":
-            stats[player]["draws"] += 1
-        elif outcome == "loss":
-            stats[player]["losses"] += 1
-
-    for player, s in stats.items():
-        s["points"] = s["wins"] * WIN_POINTS + s["draws"] * DRAW_POINTS
-        s["ppg"] = round(s["points"] / s["games"], 2) if s["games"] else 0.0
+if np is not None:
+    @njit(cache=True)
+    def tally_outcomes(player_codes, outcome_codes, n_players):
+        counts = np.zeros((n_players, 3), dtype=np.int64)
+        for i in range(player_codes.size):
+            counts[player_codes[i], outcome_codes[i]] += 1
+        return counts
+
+def build_stats_row(wins, draws, losses):
+    games = wins + draws + losses
+    points = wins * WIN_POINTS + draws * DRAW_POINTS
+    return {
+        "games": games,
+        "wins": wins,
+        "draws": draws,
+        "losses": losses,
+        "points": points,
+        "ppg": round(points / games, 2) if games else 0.0,
+    }
 
+def compute_leaderboard(player_codes, outcome_codes):
+    if not player_codes:
+        return {}
+
+    if np is not None:
+        table = tally_outcomes(
+            np.asarray(player_codes, dtype=np.int8),
+            np.asarray(outcome_codes, dtype=np.int8),
+            len(PLAYER_NAMES),
+        )
+        counts = {(idx, code): int(n)
+                  for idx, row in enumerate(table)
+                  for code, n in enumerate(row)}
+    else:
+        # Counter ingests the zipped code pairs in one C-level pass.
+        counts = Counter(zip(player_codes, outcome_codes))
+
+    stats = {}
+    for name, idx in PLAYER_INDEX.items():
+        row = build_stats_row(counts.get((idx, OUTCOME_CODE["win"]), 0),
+                              counts.get((idx, OUTCOME_CODE["draw"]), 0),
+                              counts.get((idx, OUTCOME_CODE["loss"]), 0))
+        if row["games"]:
+            stats[name] = row
     return stats
 
 # --- CSV Writers ---
-def save_game_list_csv(game_list, filename="game_list.csv"):
-    sorted_games = sorted(game_list, key=lambda x: x["end_time"])
+def save_game_list_csv(columns, filename="game_list.csv"):
+    # Expects columns already sorted by end_time (done once in main).
+    # time.gmtime avoids allocating a datetime object per row.
+    dates = [time.strftime("%Y-%m-%d", time.gmtime(t)) for t in columns.end_times]
     with open(filename, "w", newline="") as f:
         writer = csv.writer(f)
         writer.writerow(["Date", "Player", "Opponent", "Outcome", "Game URL"])
-        for game in sorted_games:
-            date = datetime.utcfromtimestamp(game["end_time"]).strftime("%Y-%m-%d")
-            writer.writerow([date, game["player"], game["opponent"], game["outcome"], game["url"]])
+        writer.writerows(zip(dates, columns.players, columns.opponents, columns.outcomes, columns.urls))
     logger.info(f"Saved game list to {filename}")
 
 def write_leaderboard_section(writer, title, stats):
@@ -123,23 +321,22 @@ def write_leaderboard_section(writer, title, stats):
     writer.writerow([])
     
 
-def save_leaderboard_csv(full_game_list, filename="leaderboard.csv"):
-    # Sort all games by time (just for consistency)
-    full_sorted = sorted(full_game_list, key=lambda x: x["end_time"])
+def save_leaderboard_csv(columns, filename="leaderboard.csv"):
+    # Expects columns already sorted by end_time (done once in main), so a
+    # single pass suffices: each player's ring buffer evicts older games as
+    # it fills and ends up holding exactly the last ROLLING_GAME_COUNT.
+    windows = defaultdict(lambda: deque(maxlen=ROLLING_GAME_COUNT))
+    for player_code, outcome_code in zip(columns.player_codes, columns.outcome_codes):
+        windows[player_code].append(outcome_code)
 
-    # --- Create per-player rolling game lists ---
-    games_by_player = defaultdict(list)
-    for game in full_sorted:
-        games_by_player[game["player"]].append(game)
-
-    rolling_games = []
-    for player, games in games_by_player.items():
-        recent_games = sorted(games, key=lambda x: x["end_time"])[-ROLLING_GAME_COUNT:]
-        rolling_games.extend(recent_games)
+    rolling_player_codes, rolling_outcome_codes = [], []
+    for player_code, window in windows.items():
+        rolling_player_codes.extend([player_code] * len(window))
+        rolling_outcome_codes.extend(window)
 
     # Compute stats
-    total_stats = compute_leaderboard(full_sorted)
-    rolling_stats = compute_leaderboard(rolling_games)
+    total_stats = compute_leaderboard(columns.player_codes, columns.outcome_codes)
+    rolling_stats = compute_leaderboard(rolling_player_codes, rolling_outcome_codes)
 
     with open(filename, "w", newline="") as f:
         writer = csv.writer(f)
@@ -149,13 +346,33 @@ def save_leaderboard_csv(full_game_list, filename="leaderboard.csv"):
 
 # --- Main ---
 def main():
-    all_game_list = []
-    for user in ALL_PLAYERS:
-        logger.info(f"Processing games for {user}")
-        parse_daily_games(user.lower(), [p.lower() for p in ALL_PLAYERS if p != user.lower()], all_game_list)
+    archive_index = load_archive_index()
+    fetched = asyncio.run(fetch_all_games(sorted(PLAYERS_LOWER), archive_index))
+
+    columns = GameColumns()
+    seen = set()
+    if fetched:
+        players, archives = zip(*fetched)
+        with ProcessPoolExecutor() as executor:
+            for rows in executor.map(classify_archive, players, archives, chunksize=4):
+                for end_time, player, opponent, outcome, url in rows:
+                    # Rows arrive unpickled from the workers, so every name
+                    # is a fresh string; interning collapses the thousands
+                    # of repeats onto one object per player with a cached
+                    # hash for the dedupe set and downstream dict keys.
+                    player = sys.intern(player)
+                    opponent = sys.intern(opponent)
+                    # A club game shows up in both players' archives; keep
+                    # only the first copy of each perspective.
+                    if (url, player) in seen:
+                        continue
+                    seen.add((url, player))
+                    columns.append(end_time, player, opponent, outcome, url)
 
-    save_game_list_csv(all_game_list)
-    save_leaderboard_csv(all_game_list)
+    columns.sort_by_end_time()
+    save_game_list_csv(columns)
+    save_archive_index(columns)
+    save_leaderboard_csv(columns)
 
 if __name__ == "__main__":
     main()